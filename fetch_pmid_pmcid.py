@@ -1,119 +1,296 @@
-import requests
-import time
+import asyncio
+import aiohttp
+import orjson
 import random
-import pandas as pd
+import sqlite3
 import threading
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import cycle, repeat
 
-class PubMedProcessor:
-    def __init__(self, molecule, credentials):
-        self.molecule = molecule
-        self.credentials = credentials  
-        self.tool = "Gene-ius-pathways"
-        self.pmid_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-        self.idconv_url = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
-
-    def get_random_credentials(self):
-        return random.choice(self.credentials)
-
-    def search_query_generator(self, molecule):
-        return f'"{molecule}"'
-
-    def fetch_all_pmids(self):
-        all_pmids = []
-        start = 0
-
-        while True:
-            email, api_key = self.get_random_credentials()
-            params = {
-                "db": "pubmed",
-                "term": self.search_query_generator(self.molecule),
-                "retmode": "json",
-                "retmax": 10000,
-                "retstart": start,
-                "tool": self.tool,
-                "email": email,
-                "api_key": api_key
-            }
-
-            while True:
-                try:
-                    response = requests.get(self.pmid_url, params=params)
-                    if response.status_code == 200:
-                        break
-                    else:
-                        print(f" Failed to fetch batch at start={start} (status {response.status_code}). Retrying in 60s...")
-                        time.sleep(60)
-                except Exception as e:
-                    print(f" Exception while fetching PMIDs: {e}. Retrying in 60s...")
-                    time.sleep(60)
-
-            data = response.json()
-            batch_pmids = data.get("esearchresult", {}).get("idlist", [])
-            if not batch_pmids:
-                break
-            all_pmids.extend(batch_pmids)
-            start += len(batch_pmids)
-            time.sleep(0.4)
-
-        return all_pmids
-
-    def convert_pmids_to_pmcids_df(self, pmids):
-        results = []
-
-        batch_size = 200
-        for i in range(0, len(pmids), batch_size):
-            batch = pmids[i:i + batch_size]
-            email, api_key = self.get_random_credentials()
-            headers = {
-                "User-Agent": f"{self.tool}/1.0 (mailto:{email})"
-            }
-
-            params = {
-                "tool": self.tool,
-                "email": email,
-                "api_key": api_key,
-                "format": "json",
-                "ids": ",".join(batch)
-            }
-
-            while True:
-                try:
-                    response = requests.get(self.idconv_url, headers=headers, params=params)
-                    if response.status_code == 200:
-                        try:
-                            data = response.json()
-                            record_map = {str(r.get("pmid")): r.get("pmcid") for r in data.get("records", [])}
-                            for pmid in batch:
-                                pmcid = record_map.get(pmid)
-                                results.append({"PMID": pmid, "PMCID": pmcid})
-                            break
-                        except Exception as e:
-                            print(f" Error parsing JSON response: {e}")
-                            break
-                    else:
-                        print(f" Failed to convert batch PMIDs (status {response.status_code}). Retrying in 60s...")
-                        time.sleep(60)
-                except Exception as e:
-                    print(f" Exception during PMCID fetch: {e}. Retrying in 60s...")
-                    time.sleep(60)
-
-            time.sleep(0.4)  
-
-        return pd.DataFrame(results)
+TOOL = "Gene-ius-pathways"
+PMID_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+IDCONV_URL = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+# How long 429/5xx/connection failures keep being retried before giving up.
+MAX_RETRY_SECONDS = 30 * 60
+NCBI_REQUESTS_PER_SECOND = 9.5
+CACHE_PATH = "ncbi_cache.sqlite"
+CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+
+class RateLimiter:
+    def __init__(self, rps):
+        self.interval = 1 / rps
+        self.next = 0.0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        wait = max(0.0, self.next - now)
+        self.next = max(now, self.next) + self.interval
+        await asyncio.sleep(wait)
+
+
+def _backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 0.25)
+
+
+class NCBIRequestError(Exception):
+    pass
+
+
+async def _get_with_backoff(session, url, limiter, max_retry_seconds=MAX_RETRY_SECONDS, **kw):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_retry_seconds
+    attempt = 0
+    while True:
+        retry_after = None
+        await limiter.acquire()
+        try:
+            async with session.get(url, **kw) as response:
+                if response.status == 200:
+                    return await response.read()
+                if response.status != 429 and response.status < 500:
+                    raise NCBIRequestError(f"{url} returned status {response.status}")
+                retry_after = response.headers.get("Retry-After")
+                reason = f"status {response.status}"
+        except NCBIRequestError:
+            raise
+        except Exception as e:
+            reason = f"exception: {e}"
+        delay = _backoff_delay(attempt, retry_after)
+        if loop.time() + delay > deadline:
+            raise NCBIRequestError(f"{url} still failing after {max_retry_seconds}s ({reason})")
+        print(f" Request to {url} failed ({reason}). Retrying in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+# PMID -> PMCID lookups from idconv, kept per PMID so molecules that share
+# literature reuse each other's results. PMIDs with no PMCID are stored as NULL.
+class PMCIDCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Calls come from asyncio.to_thread workers, serialized by self.lock.
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pmcids (pmid TEXT PRIMARY KEY, pmcid TEXT, stored_at REAL)"
+        )
+
+    def get_many(self, pmids):
+        found = {}
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for i in range(0, len(pmids), 500):
+                chunk = pmids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT pmid, pmcid FROM pmcids WHERE stored_at >= ? AND pmid IN ({placeholders})",
+                    (cutoff, *chunk),
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def set_many(self, record_map):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pmcids (pmid, pmcid, stored_at) VALUES (?, ?, ?)",
+                [(pmid, pmcid, now) for pmid, pmcid in record_map.items()],
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+# === State shared by every molecule in one process ===
+class Context:
+    def __init__(self, session: aiohttp.ClientSession, credentials, cache: PMCIDCache,
+                 rps=NCBI_REQUESTS_PER_SECOND):
+        self.session = session
+        self.cache = cache
+        self.credentials_iter = cycle(credentials)
+        self.limiters = {api_key: RateLimiter(rps) for _, api_key in credentials}
+
+    # Safe without a lock: the event loop never switches tasks inside next().
+    def next_credentials(self):
+        return next(self.credentials_iter)
+
+
+def search_query_generator(molecule):
+    return f'"{molecule}"'
+
+
+async def fetch_all_pmids(ctx, molecule):
+    all_pmids = []
+    start = 0
+
+    while True:
+        email, api_key = ctx.next_credentials()
+        params = {
+            "db": "pubmed",
+            "term": search_query_generator(molecule),
+            "retmode": "json",
+            "retmax": 10000,
+            "retstart": start,
+            "tool": TOOL,
+            "email": email,
+            "api_key": api_key
+        }
+
+        body = await _get_with_backoff(ctx.session, PMID_URL, ctx.limiters[api_key], params=params)
+        try:
+            batch_pmids = orjson.loads(body)["esearchresult"]["idlist"]
+        except Exception as e:
+            raise NCBIRequestError(f"Error parsing esearch response at retstart={start}: {e}") from e
+        if not batch_pmids:
+            break
+        all_pmids.extend(batch_pmids)
+        start += len(batch_pmids)
+
+    return all_pmids
+
+
+async def _convert_batch(ctx, batch, semaphore):
+    email, api_key = ctx.next_credentials()
+    headers = {
+        "User-Agent": f"{TOOL}/1.0 (mailto:{email})"
+    }
+
+    params = {
+        "tool": TOOL,
+        "email": email,
+        "api_key": api_key,
+        "format": "json",
+        "ids": ",".join(batch)
+    }
+
+    try:
+        async with semaphore:
+            body = await _get_with_backoff(
+                ctx.session, IDCONV_URL, ctx.limiters[api_key], headers=headers, params=params
+            )
+    except NCBIRequestError as e:
+        print(f" Failed to convert batch PMIDs: {e}")
+        return None, str(e)
+    try:
+        records = orjson.loads(body)["records"]
+        record_map = {str(r.get("pmid")): r.get("pmcid") for r in records}
+    except Exception as e:
+        print(f" Error parsing JSON response: {e}")
+        return None, f"Error parsing JSON response: {e}"
+
+    # Only responses that parsed into idconv records reach the cache.
+    batch_map = {pmid: record_map.get(pmid) for pmid in batch}
+    await asyncio.to_thread(ctx.cache.set_many, batch_map)
+    return batch_map, ""
+
+
+async def convert_pmids_to_pmcids_df(ctx, pmids, max_concurrent_batches=8):
+    pmids = list(dict.fromkeys(pmids))
+    pmcid_map = await asyncio.to_thread(ctx.cache.get_many, pmids)
+    misses = [pmid for pmid in pmids if pmid not in pmcid_map]
+
+    batch_size = 200
+    semaphore = asyncio.Semaphore(max_concurrent_batches)
+    batches = [misses[i:i + batch_size] for i in range(0, len(misses), batch_size)]
+    batch_results = await asyncio.gather(
+        *[_convert_batch(ctx, batch, semaphore) for batch in batches]
+    )
+
+    # PMIDs from failed batches stay in the frame with the reason, so an
+    # incomplete conversion is visible in the CSV.
+    errors = {}
+    for batch, (batch_map, error) in zip(batches, batch_results):
+        if batch_map is None:
+            errors.update(dict.fromkeys(batch, error))
+        else:
+            pmcid_map.update(batch_map)
+
+    return pd.DataFrame({
+        "PMID": pmids,
+        "PMCID": pd.array([pmcid_map.get(pmid) for pmid in pmids], dtype="string"),
+        "error": [errors.get(pmid, "") for pmid in pmids],
+    })
 
 
 # === Runner for a single molecule ===
-def run_for_molecule(mol, credentials):
-    processor = PubMedProcessor(mol, credentials)
-    pmids = processor.fetch_all_pmids()
-    print(f"[{mol}]  PMIDs fetched: {len(pmids)}")
+class PubMedProcessor:
+    def __init__(self, ctx: Context):
+        self.ctx = ctx
+
+    # Failures stay with their molecule, as they did with one thread per molecule.
+    async def __call__(self, mol):
+        try:
+            await self._process(mol)
+        except Exception as e:
+            print(f"[{mol}] Failed: {e!r}")
+
+    async def _process(self, mol):
+        try:
+            pmids = await fetch_all_pmids(self.ctx, mol)
+        except NCBIRequestError as e:
+            print(f"[{mol}] Failed to fetch PMIDs: {e}")
+            return
+        print(f"[{mol}]  PMIDs fetched: {len(pmids)}")
+
+        if pmids:
+            df = await convert_pmids_to_pmcids_df(self.ctx, pmids)
+            df.to_csv(f"{mol}_pmid_to_pmcid.csv", index=False)
+            print(f"[{mol}]  Saved to {mol}_pmid_to_pmcid.csv")
+            failed = int((df["error"] != "").sum())
+            if failed:
+                print(f"[{mol}]  {failed} PMIDs could not be converted; see the error column.")
+        else:
+            print(f"[{mol}] No PMIDs found.")
+
+
+async def main(molecules, credentials, rps=NCBI_REQUESTS_PER_SECOND, max_concurrent_molecules=8):
+    cache = PMCIDCache()
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=10)
+    semaphore = asyncio.Semaphore(max_concurrent_molecules)
+
+    async def run_bounded(processor, mol):
+        async with semaphore:
+            await processor(mol)
 
-    if pmids:
-        df = processor.convert_pmids_to_pmcids_df(pmids)
-        df.to_csv(f"{mol}_pmid_to_pmcid.csv", index=False)
-        print(f"[{mol}]  Saved to {mol}_pmid_to_pmcid.csv")
-    else:
-        print(f"[{mol}] No PMIDs found.")
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            processor = PubMedProcessor(Context(session, credentials, cache, rps))
+            await asyncio.gather(*[run_bounded(processor, mol) for mol in molecules])
+    finally:
+        cache.close()
+
+
+# === Runner for one worker process; top-level so it can be pickled ===
+def run_molecules_in_process(molecules, credentials, rps):
+    asyncio.run(main(molecules, credentials, rps))
+
+
+def run_all(molecules, credentials, processes=None):
+    processes = processes or min(len(molecules), 6)
+    if processes <= 1:
+        asyncio.run(main(molecules, credentials))
+        return
+
+    # Every process gets its own limiters, so split the per-key budget between them.
+    shards = [molecules[i::processes] for i in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        list(pool.map(
+            run_molecules_in_process,
+            shards,
+            repeat(credentials),
+            repeat(NCBI_REQUESTS_PER_SECOND / processes),
+        ))
 
 
 if __name__ == "__main__":
@@ -125,11 +302,4 @@ if __name__ == "__main__":
 
     molecules = ["IL19"]
 
-    threads = []
-    for mol in molecules:
-        t = threading.Thread(target=run_for_molecule, args=(mol, credentials))
-        t.start()
-        threads.append(t)
-
-    for t in threads:
-        t.join()
+    run_all(molecules, credentials)
@@ -1,10 +1,35 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import pandas as pd
-import xml.etree.ElementTree as ET
+from lxml import etree
 import time
-from typing import List
+import random
+import gzip
+import io
+import threading
+import orjson
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Tuple
 import boto3
-from botocore.exceptions import BotoCoreError, NoCredentialsError
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=True)
+
+
+def normalize_pmcid(pmcid: str) -> str:
+    pmcid = pmcid.strip()
+    return f"PMC{pmcid[3:]}" if pmcid.upper().startswith("PMC") else f"PMC{pmcid}"
+
+
+def article_pmcid(article):
+    for id_type in ("pmc", "pmcid"):
+        value = article.findtext(f"front/article-meta/article-id[@pub-id-type='{id_type}']")
+        if value:
+            return normalize_pmcid(value)
+    return None
 
 
 class PMCXMLEDownloaderSync:
@@ -17,9 +42,12 @@ class PMCXMLEDownloaderSync:
         aws_secret_access_key: str,
         s3_bucket_name: str = "geneius-pathway-data",
         s3_prefix: str = "pmc_xml_13/",
-        batch_size: int = 100,
+        batch_size: int = 200,
         max_retries: int = 3,
-        retry_delay: int = 60, 
+        retry_delay: int = 60,
+        upload_workers: int = 16,
+        batch_upload: bool = False,
+        compress_xml: bool = False,
     ):
         self.email = email
         self.api_key = api_key
@@ -29,77 +57,226 @@ class PMCXMLEDownloaderSync:
         self.retry_delay = retry_delay
         self.s3_bucket_name = s3_bucket_name
         self.s3_prefix = s3_prefix
-        self.results = []
+        self.batch_upload = batch_upload
+        self.compress_xml = compress_xml
+        self.run_id = time.strftime("%Y%m%dT%H%M%S")
+        self.result_pmcids = []
+        self.result_saved = []
+        self.result_errors = []
+        self.results_lock = threading.Lock()
+        self.s3_executor = ThreadPoolExecutor(max_workers=upload_workers)
+        # Bounds how many serialized articles can wait in memory for S3.
+        self.upload_slots = threading.BoundedSemaphore(upload_workers * 2)
+        self.upload_futures = {}
         self.s3_client = boto3.client(
             "s3",
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
         )
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+        retries = Retry(
+            total=5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,
+            backoff_factor=0.5,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retries)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.s3_executor.shutdown(wait=True)
+        self.session.close()
 
-    def _upload_to_s3(self, pmcid: str, xml_content: str):
-        key = f"{self.s3_prefix}{pmcid}.xml"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _record_result(self, pmcid: str, saved: str, error: str):
+        with self.results_lock:
+            self.result_pmcids.append(pmcid)
+            self.result_saved.append(saved)
+            self.result_errors.append(error)
+
+    def _s3_key(self, pmcid: str) -> str:
+        suffix = ".xml.gz" if self.compress_xml else ".xml"
+        return f"{self.s3_prefix}{pmcid}{suffix}"
+
+    def _upload_to_s3(self, pmcid: str, xml_content: bytes):
+        key = self._s3_key(pmcid)
+        content_type = "application/xml"
+        # A plain .xml.gz object: no ContentEncoding, or HTTP clients would
+        # transparently inflate it and save plain XML under a .gz name.
+        if self.compress_xml:
+            xml_content = gzip.compress(xml_content, compresslevel=1)
+            content_type = "application/gzip"
         try:
             self.s3_client.put_object(
                 Bucket=self.s3_bucket_name,
                 Key=key,
-                Body=xml_content.encode("utf-8"),
-                ContentType="application/xml",
+                Body=xml_content,
+                ContentType=content_type,
+            )
+            print(f" Uploaded s3://{self.s3_bucket_name}/{key}")
+            self._record_result(pmcid, "Yes", "")
+        except (BotoCoreError, ClientError, NoCredentialsError) as e:
+            print(f" Failed to upload {key} to S3: {e}")
+            self._record_result(pmcid, "No", str(e))
+
+    def _upload_batch_to_s3(self, batch_num: int, records: List[Tuple[str, bytes]]):
+        # Keys carry the run id so a later run under the same prefix can't overwrite them.
+        batch_key = f"{self.s3_prefix}batches/{self.run_id}-{batch_num:06d}"
+        key = f"{batch_key}.jsonl.gz"
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as gz:
+            for pmcid, xml_content in records:
+                gz.write(orjson.dumps({"pmcid": pmcid, "xml": xml_content.decode("utf-8")}) + b"\n")
+        buffer.seek(0)
+        try:
+            self.s3_client.upload_fileobj(
+                buffer,
+                self.s3_bucket_name,
+                key,
+                ExtraArgs={"ContentType": "application/gzip"},
+                Config=TRANSFER_CONFIG,
+            )
+            # Manifest of the PMCIDs in the batch, read back by _existing_pmcids.
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket_name,
+                Key=f"{batch_key}.pmcids",
+                Body="\n".join(pmcid for pmcid, _ in records).encode("utf-8"),
+                ContentType="text/plain",
             )
-            print(f" Uploaded {pmcid}.xml to s3://{self.s3_bucket_name}/{key}")
-            self.results.append({"pmcid": pmcid, "saved": "Yes", "error": ""})
-        except (BotoCoreError, NoCredentialsError) as e:
-            print(f" Failed to upload {pmcid}.xml to S3: {e}")
-            self.results.append({"pmcid": pmcid, "saved": "No", "error": str(e)})
+            print(f" Uploaded batch {batch_num} ({len(records)} articles) to s3://{self.s3_bucket_name}/{key}")
+            for pmcid, _ in records:
+                self._record_result(pmcid, "Yes", "")
+        except (BotoCoreError, ClientError, NoCredentialsError, S3UploadFailedError) as e:
+            print(f" Failed to upload batch {batch_num} to S3: {e}")
+            for pmcid, _ in records:
+                self._record_result(pmcid, "No", str(e))
+
+    def _submit_upload(self, pmcids: List[str], fn, *args):
+        self.upload_slots.acquire()
+        future = self.s3_executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self.upload_slots.release())
+        self.upload_futures[future] = pmcids
 
     def _download_xml_batch(self, batch: List[str], batch_num: int):
         url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-        params = {
-            "db": "pmc",
-            "id": ",".join(batch),
-            "retmode": "xml",
-            "tool": "BulkDownloader",
-            "email": self.email,
-            "api_key": self.api_key,
-        }
+        requested = {normalize_pmcid(pmcid): pmcid for pmcid in batch}
+        # Articles are handed off while the body streams in, so remember them
+        # across attempts and only re-request the ones not seen yet.
+        present = set()
+        records = []
+
+        missing_error = "not returned"
 
         for attempt in range(1, self.max_retries + 1):
+            remaining = [pmcid for pmcid in batch if pmcid not in present]
+            if not remaining:
+                break
+            params = {
+                "db": "pmc",
+                "id": ",".join(remaining),
+                "retmode": "xml",
+                "tool": "BulkDownloader",
+                "email": self.email,
+                "api_key": self.api_key,
+            }
             try:
-                response = requests.get(url, params=params, timeout=60)
-                if response.status_code == 200:
-                    xml_text = response.text
-                    root = ET.fromstring(xml_text)
-                    articles = root.findall(".//article")
-                    for i, article in enumerate(articles):
-                        pmcid = batch[i]
-                        article_xml = ET.tostring(article, encoding="unicode")
-                        self._upload_to_s3(pmcid, article_xml)
-                    print(f" Batch {batch_num}: {len(articles)} articles uploaded.")
-                    return
-                else:
-                    print(f" Batch {batch_num} HTTP error: {response.status_code}")
+                with self.session.post(url, data=params, timeout=60, stream=True) as response:
+                    if response.status_code == 200:
+                        response.raw.decode_content = True
+                        for _, article in etree.iterparse(response.raw, events=("end",), tag="article"):
+                            real_pmcid = article_pmcid(article)
+                            pmcid = requested.get(real_pmcid)
+                            if pmcid is None or pmcid in present:
+                                print(f" Batch {batch_num}: skipping article with unexpected PMCID {real_pmcid}")
+                            else:
+                                present.add(pmcid)
+                                article_xml = etree.tostring(article, encoding="utf-8")
+                                if self.batch_upload:
+                                    records.append((pmcid, article_xml))
+                                else:
+                                    self._submit_upload([pmcid], self._upload_to_s3, pmcid, article_xml)
+                            article.clear()
+                            while article.getprevious() is not None:
+                                del article.getparent()[0]
+                        print(f" Batch {batch_num}: {len(present)} articles queued for upload, "
+                              f"{len(batch) - len(present)} not returned.")
+                        break
+                    else:
+                        print(f" Batch {batch_num} HTTP error: {response.status_code}")
             except Exception as e:
                 print(f" Attempt {attempt} for batch {batch_num} failed: {e}")
 
             if attempt < self.max_retries:
-                print(f" Retrying batch {batch_num} in {self.retry_delay}s...")
-                time.sleep(self.retry_delay)
+                delay = min(self.retry_delay, 0.5 * 2 ** attempt) + random.uniform(0, 0.25)
+                print(f" Retrying batch {batch_num} in {delay:.1f}s...")
+                time.sleep(delay)
             else:
                 print(f" Batch {batch_num} permanently failed after {self.max_retries} attempts.")
-                for pmcid in batch:
-                    self.results.append({"pmcid": pmcid, "saved": "No", "error": "Batch failed after retries"})
+                missing_error = "Batch failed after retries"
+
+        if records:
+            self._submit_upload([pmcid for pmcid, _ in records], self._upload_batch_to_s3, batch_num, records)
+        for pmcid in batch:
+            if pmcid not in present:
+                self._record_result(pmcid, "No", missing_error)
+
+    # Best effort: without s3:ListBucket/GetObject nothing is skipped.
+    def _existing_pmcids(self) -> set:
+        existing = set()
+        try:
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.s3_bucket_name, Prefix=self.s3_prefix):
+                for obj in page.get("Contents", []):
+                    name = obj["Key"][len(self.s3_prefix):]
+                    if name.startswith("batches/") and name.endswith(".pmcids"):
+                        body = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=obj["Key"])["Body"].read()
+                        existing.update(body.decode("utf-8").split())
+                    elif "/" not in name:
+                        existing.add(name.removesuffix(".gz").removesuffix(".xml"))
+        except (BotoCoreError, ClientError) as e:
+            print(f" Could not list existing objects under s3://{self.s3_bucket_name}/{self.s3_prefix}: {e}. "
+                  f"Downloading all PMCIDs.")
+            return set()
+        return existing
 
     def run(self):
         start_time = time.time()
+        existing = self._existing_pmcids()
+        skipped = [p for p in self.pmcids if p in existing]
+        to_fetch = [p for p in self.pmcids if p not in existing]
+        for pmcid in skipped:
+            self._record_result(pmcid, "Yes", "already in S3")
+        print(f" Skipping {len(skipped)} PMCIDs already present under s3://{self.s3_bucket_name}/{self.s3_prefix}")
+
         batches = [
-            self.pmcids[i: i + self.batch_size]
-            for i in range(0, len(self.pmcids), self.batch_size)
+            to_fetch[i: i + self.batch_size]
+            for i in range(0, len(to_fetch), self.batch_size)
         ]
         for i, batch in enumerate(batches):
             self._download_xml_batch(batch, i + 1)
+        wait(self.upload_futures)
+        for future, pmcids in self.upload_futures.items():
+            if future.exception() is not None:
+                for pmcid in pmcids:
+                    self._record_result(pmcid, "No", str(future.exception()))
+        self.upload_futures = {}
 
         duration = time.time() - start_time
-        print(f"\n Task completed in {duration:.2f} seconds for {len(self.pmcids)} PMCIDs.")
-        return self.results
+        print(f"\n Task completed in {duration:.2f} seconds for {len(self.pmcids)} PMCIDs "
+              f"({len(to_fetch)} downloaded, {len(skipped)} already in S3).")
+        return pd.DataFrame({
+            "pmcid": self.result_pmcids,
+            "saved": self.result_saved,
+            "error": self.result_errors,
+        })
 
 
 # ======================
@@ -107,24 +284,22 @@ class PMCXMLEDownloaderSync:
 # ======================
 if __name__ == "__main__":
     df = pd.read_csv(r"C:\Users\User\Downloads\PMC_DATA.csv")
-    pmcids = df["pmc_id"].dropna().astype(str).str.strip().tolist()
-
-    downloader = PMCXMLEDownloaderSync(
-    email=" ",
-    api_key=" ",
-    pmcids=pmcids,
-    aws_access_key_id=" ",
-    aws_secret_access_key=" ",
-    s3_bucket_name="geneius-pathway-data",
-    s3_prefix="pmc_xml_8/",
-    batch_size=100,
-    max_retries=3,
-    retry_delay=60,  
-)
-
-    results = downloader.run()
-
-    summary_df = pd.DataFrame(results)
+    pmcids = pd.unique(df["pmc_id"].dropna().astype(str).str.strip()).tolist()
+
+    with PMCXMLEDownloaderSync(
+        email=" ",
+        api_key=" ",
+        pmcids=pmcids,
+        aws_access_key_id=" ",
+        aws_secret_access_key=" ",
+        s3_bucket_name="geneius-pathway-data",
+        s3_prefix="pmc_xml_8/",
+        batch_size=200,
+        max_retries=3,
+        retry_delay=60,
+    ) as downloader:
+        summary_df = downloader.run()
+
     summary_df.to_csv("pmc_upload_summary.csv", index=False)
     print("\n Summary saved to pmc_upload_summary.csv")
 
@@ -136,7 +311,7 @@ if __name__ == "__main__":
 import asyncio
 import aiohttp
 import pandas as pd
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 import time
 import os
 from typing import List
@@ -152,7 +327,6 @@ class PMCXMLEDownloader:
         max_concurrent_requests: int = 3,
         max_retries: int = 3,
         retry_delay: int = 10,
-        retry_delay: int = 60,
     ):
         self.email = email
         self.api_key = api_key
@@ -164,10 +338,10 @@ class PMCXMLEDownloader:
         self.retry_delay = retry_delay
         os.makedirs(self.output_dir, exist_ok=True)
 
-    async def _save_locally(self, pmcid: str, xml_content: str):
+    async def _save_locally(self, pmcid: str, xml_content: bytes):
         file_path = os.path.join(self.output_dir, f"{pmcid}.xml")
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
+            with open(file_path, "wb") as f:
                 f.write(xml_content)
             print(f"✅ Saved {pmcid}.xml to {file_path}")
         except Exception as e:
@@ -187,18 +361,22 @@ class PMCXMLEDownloader:
         async with self.semaphore:
             for attempt in range(1, self.max_retries + 1):
                 try:
-                    async with session.get(url, params=params) as response:
+                    async with session.post(url, data=params) as response:
                         if response.status == 200:
-                            xml_text = await response.text()
-                            root = ET.fromstring(xml_text)
+                            xml_bytes = await response.read()
+                            root = ET.fromstring(xml_bytes)
                             articles = root.findall(".//article")
+                            requested = {normalize_pmcid(pmcid): pmcid for pmcid in batch}
                             tasks = []
-                            for i, article in enumerate(articles):
-                                pmcid = batch[i]
-                                article_xml = ET.tostring(article, encoding="unicode")
-                                tasks.append(self._save_locally(pmcid, article_xml))
+                            for article in articles:
+                                pmcid = requested.get(article_pmcid(article))
+                                if pmcid is not None:
+                                    article_xml = ET.tostring(article, encoding="utf-8", xml_declaration=False)
+                                    tasks.append(self._save_locally(pmcid, article_xml))
+                                article.clear()
+                            root.clear()
                             await asyncio.gather(*tasks)
-                            print(f"📦 Batch {batch_num}: {len(articles)} articles saved.")
+                            print(f"📦 Batch {batch_num}: {len(tasks)} articles saved.")
                             return
                         else:
                             print(f"❌ Batch {batch_num} failed: HTTP {response.status}")